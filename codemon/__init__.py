@@ -1,4 +1,10 @@
+import sys
+
 from .codemon import *
+from .collector import *
 from .config import *
 from .datastructures import *
 from .watcher import *
+
+if sys.version_info >= (3, 7):
+    from .engine import *
@@ -1,11 +1,13 @@
 import itertools
 import sys
+import traceback
 
 from coverage import Coverage
 
+from .collector import LineCollector
 from .watcher import Watcher
 from .config import Config
-from .datastructures import SourceMap
+from .datastructures import ResultCache, ShardedSourceMap, SourceMap
 
 
 __all__ = ['InfluenceMapper', 'Codemon']
@@ -34,11 +36,21 @@ class InfluenceMapper(object):
         assert isinstance(config, Config)
 
         self.config = config
-        self.source_map = SourceMap.read_from_file()
+        self.source_map = self.read_source_map()
+        self.result_cache = ResultCache.read_from_file()
         self._tests = None
         self.use_cached = use_cached
         self.verbosity = verbosity
 
+    def read_source_map(self):
+        if self.config.packages:
+            return ShardedSourceMap.read_from_file(self.config.packages)
+
+        return SourceMap.read_from_file()
+
+    def write_source_map(self):
+        type(self.source_map).write_to_file(self.source_map)
+
     def setup(self):
         """Hook to perform any optional setup before running."""
         pass
@@ -53,29 +65,97 @@ class InfluenceMapper(object):
             'Subclasses should implement {}'.format(self.__name__)
         )
 
-    def run_affected_tests(self, filenames):
-        # TODO: finer granularity
+    def partition_suite(self, filenames):
+        """
+        Splits the tests affected by `filenames` into those that must be run
+        and those whose covered lines are unchanged since their last run.
+
+        Returns a tuple of (tests_to_run, cached_results, fingerprints).
+        """
         suite = self.source_map.suite(filenames)
+        fingerprints = self.source_map.fingerprints(suite)
 
-        if self.verbosity >= 2:
-            output_message = '\nThe following files have changed:\n'
-            output_message += '\n'.join(filenames)
-            output_message += '\nRunning the following tests:\n'
-            output_message += '\n'.join(suite)
+        cached_results = {}
+        tests_to_run = set()
+
+        for test_name in suite:
+            hit, outcome = self.result_cache.lookup(test_name,
+                                                    fingerprints[test_name])
+            if hit:
+                cached_results[test_name] = outcome
+            else:
+                tests_to_run.add(test_name)
 
-            sys.stdout.write(output_message.format(filenames) + '\n')
+        return tests_to_run, cached_results, fingerprints
+
+    def record_results(self, results, fingerprints):
+        """Caches `results` against the fingerprints they were run with."""
+        for test_name, outcome in results.items():
+            if fingerprints.get(test_name) is not None:
+                self.result_cache.record(test_name, fingerprints[test_name],
+                                         outcome)
+
+    def report_affected_tests(self, filenames, tests_to_run, cached_results):
+        if self.verbosity < 2:
+            return
 
-        self.test_suite(suite)
+        output_message = '\nThe following files have changed:\n'
+        output_message += '\n'.join(filenames)
+        output_message += '\nRunning the following tests:\n'
+        output_message += '\n'.join(tests_to_run)
+
+        if cached_results:
+            output_message += '\nSkipping the following unchanged tests:\n'
+            output_message += '\n'.join(
+                '{} (cached: {})'.format(test_name, outcome)
+                for test_name, outcome in cached_results.items()
+            )
+
+        sys.stdout.write(output_message + '\n')
+
+    def run_affected_tests(self, filenames):
+        tests_to_run, cached_results, fingerprints = \
+            self.partition_suite(filenames)
+
+        self.report_affected_tests(filenames, tests_to_run, cached_results)
+
+        results = {}
+        if tests_to_run:
+            results = dict(self.test_suite(tests_to_run) or {})
+
+        self.record_results(results, fingerprints)
+
+        if results:
+            ResultCache.write_to_file(self.result_cache)
+
+        results.update(cached_results)
+        return results
 
     def test_suite(self, suite):
         """
         Hook to perform a test on change. `suite` will be a set of strings
         where each string is the absolute path of a test.
+
+        Optionally return a dict of test name -> outcome (any msgpack
+        serializable value, e.g. `True`/`False`). Returned outcomes are cached
+        and tests whose covered lines have not changed since are skipped next
+        time, with their cached outcome reported instead.
         """
         raise NotImplementedError(
             'Subclasses should implement {}'.format(self.__name__)
         )
 
+    def test_command(self, test_name):
+        """
+        Optional hook returning the command (a list of arguments) that runs
+        a single test in a subprocess. The test passes if the command exits
+        with status 0.
+
+        Used by `AsyncCodemon` to run tests concurrently with async I/O.
+        Return None (the default) to have it fall back to `test_suite`.
+        """
+        return None
+
     def filter_omitted_tests(self, tests):
         suite = []
 
@@ -99,23 +179,80 @@ class InfluenceMapper(object):
             'Subclasses should implement {}'.format(self.__name__)
         )
 
+    def make_collector(self):
+        """
+        Returns a collector with coverage.py's `start`, `stop` and `get_data`
+        interface to record the lines a test runs.
+        """
+        collector = self.config.collector
+
+        if collector == 'auto':
+            use_monitoring = LineCollector.is_available()
+        else:
+            use_monitoring = collector == 'monitoring'
+
+        if use_monitoring and not LineCollector.is_supported():
+            raise Exception('The monitoring collector requires Python 3.12+!')
+
+        if use_monitoring:
+            return LineCollector(source=self.config.source,
+                                 omit=self.config.omit)
+
+        return Coverage(source=self.config.source, omit=self.config.omit)
+
     def run_coverage(self, test_name):
-        cov = Coverage(source=self.config.source, omit=self.config.omit)
-        cov.start()
-        self.map_test(test_name)
-        cov.stop()
+        collector = self.make_collector()
+        collector.start()
 
-        return cov.get_data()
+        try:
+            self.map_test(test_name)
+        finally:
+            collector.stop()
+
+        return collector.get_data()
 
     def record_affected_files(self, coverage_data, test_name):
-        line_counts = coverage_data.line_counts(fullpath=True).items()
+        for filename in coverage_data.measured_files():
+            line_nums = coverage_data.lines(filename) or []
+            self.source_map[filename] = (test_name, line_nums)
 
-        for filename, lines_counted in line_counts:
-            if lines_counted == 0:
-                self.source_map.touch(filename)
+    def remap_tests(self, tests):
+        """
+        Re-computes the influence map of each test in `tests`. Tests that
+        fail to map are reported and keep their previous map.
 
-            line_nums = coverage_data.lines(filename)
-            self.source_map[filename] = (test_name, line_nums)
+        Returns the set of tests that were re-mapped.
+        """
+        remapped = set()
+
+        for test_name in tests:
+            try:
+                coverage_data = self.run_coverage(test_name)
+            except Exception:
+                output_message = '[CODEMON] Error re-mapping {}:\n'.format(
+                    test_name
+                )
+                output_message += traceback.format_exc()
+                sys.stdout.write(output_message)
+                continue
+
+            self.source_map.discard(test_name)
+            self.record_affected_files(coverage_data, test_name)
+            remapped.add(test_name)
+
+        # files only covered by re-mapped tests are up to date again
+        filenames = {filename
+                     for files in self.source_map.covered_lines(
+                         remapped
+                     ).values()
+                     for filename in files}
+
+        self.source_map.refresh_layouts([
+            filename for filename in filenames
+            if self.source_map.suite([filename]) <= remapped
+        ])
+
+        return remapped
 
     @property
     def untested_files(self):
@@ -133,7 +270,7 @@ class InfluenceMapper(object):
             coverage_data = self.run_coverage(test_name)
 
             if self.verbosity < 2:
-                sys.stdout.write(spinner.next())
+                sys.stdout.write(next(spinner))
                 sys.stdout.flush()
 
             self.record_affected_files(coverage_data, test_name)
@@ -171,8 +308,9 @@ class InfluenceMapper(object):
             raise Exception(error_message)
         else:
             self.match_tests_to_source(tests)
+            self.source_map.refresh_layouts()
             self.cleanup()
-            SourceMap.write_to_file(self.source_map)
+            self.write_source_map()
 
         return self.files
 
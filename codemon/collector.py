@@ -0,0 +1,193 @@
+from collections import defaultdict
+
+import fnmatch
+import os
+import sys
+
+
+__all__ = ['LineCollector']
+
+
+_THIS_FILE = os.path.abspath(__file__)
+
+
+class LineData(object):
+    """LineData
+
+    The lines executed in each file, with the subset of the interface of
+    coverage.py's `CoverageData` that `record_affected_files` consumes.
+    """
+
+    def __init__(self):
+        self._lines = defaultdict(set)
+
+    def add_line(self, filename, line_num):
+        self._lines[filename].add(line_num)
+
+    def add_file(self, filename):
+        """Records `filename` as measured, even if none of its lines ran."""
+        self._lines[filename]
+
+    def measured_files(self):
+        return list(self._lines)
+
+    def lines(self, filename):
+        return sorted(self._lines.get(filename, []))
+
+
+class LineCollector(object):
+    """LineCollector
+
+    A low-overhead alternative to coverage.py for mapping tests, built on
+    PEP 669 `sys.monitoring` (Python 3.12+).
+
+    Only records which lines ran: each location is disabled after its first
+    hit so it costs nothing afterwards. Files are filtered by `source` and
+    `omit` like coverage.py does. Has the same `start`/`stop`/`get_data`
+    interface as `coverage.Coverage`. Like coverage.py, source files that
+    never ran are reported with no lines.
+
+    Claims a free `sys.monitoring` tool id on `start`, so it can run under
+    coverage.py or a debugger using their own.
+    """
+
+    TOOL_NAME = 'codemon'
+
+    def __init__(self, source=None, omit=None):
+        source = source or ['.']
+        if not isinstance(source, (list, tuple)):
+            source = [source]
+        omit = omit or []
+        if not isinstance(omit, (list, tuple)):
+            omit = [omit]
+
+        self.source = [self._abspath_pattern(pattern) for pattern in source]
+        self.omit = [self._abspath_pattern(pattern) for pattern in omit]
+        self.data = LineData()
+        self._measured = {}
+        self._tool_id = None
+
+    @classmethod
+    def is_supported(cls):
+        return hasattr(sys, 'monitoring')
+
+    @staticmethod
+    def _tool_ids():
+        """
+        Returns the tool ids to try, those not reserved for a kind of tool
+        first.
+        """
+        monitoring = sys.monitoring
+        reserved = [monitoring.DEBUGGER_ID, monitoring.COVERAGE_ID,
+                    monitoring.PROFILER_ID, monitoring.OPTIMIZER_ID]
+        unreserved = [tool_id for tool_id in range(6)
+                      if tool_id not in reserved]
+
+        return unreserved + [monitoring.COVERAGE_ID, monitoring.PROFILER_ID]
+
+    @classmethod
+    def is_available(cls):
+        """Returns whether `sys.monitoring` exists and has a free tool id."""
+        if not cls.is_supported():
+            return False
+
+        return any(sys.monitoring.get_tool(tool_id) is None
+                   for tool_id in cls._tool_ids())
+
+    def _claim_tool_id(self):
+        for tool_id in self._tool_ids():
+            if sys.monitoring.get_tool(tool_id) is not None:
+                continue
+
+            try:
+                sys.monitoring.use_tool_id(tool_id, self.TOOL_NAME)
+            except ValueError:
+                continue
+
+            return tool_id
+
+        raise Exception('No free sys.monitoring tool id to collect lines!')
+
+    @staticmethod
+    def _abspath_pattern(pattern):
+        if pattern.startswith('*'):
+            return pattern
+
+        return os.path.abspath(pattern)
+
+    @staticmethod
+    def _matches(filename, pattern):
+        if any(char in pattern for char in '*?['):
+            return fnmatch.fnmatch(filename, pattern)
+
+        return filename == pattern or filename.startswith(pattern + os.sep)
+
+    def is_measured(self, filename):
+        """Returns whether lines in `filename` should be recorded."""
+        if filename not in self._measured:
+            path = os.path.abspath(filename)
+
+            self._measured[filename] = (
+                os.path.isfile(path) and
+                path != _THIS_FILE and
+                any(self._matches(path, pattern) for pattern in self.source) and
+                not any(self._matches(path, pattern) for pattern in self.omit)
+            )
+
+        return self._measured[filename]
+
+    def _on_line(self, code, line_num):
+        if self.is_measured(code.co_filename):
+            self.data.add_line(os.path.abspath(code.co_filename), line_num)
+
+        return sys.monitoring.DISABLE
+
+    def start(self):
+        monitoring = sys.monitoring
+        tool_id = self._tool_id = self._claim_tool_id()
+
+        monitoring.register_callback(tool_id, monitoring.events.LINE,
+                                     self._on_line)
+
+        # locations disabled while mapping the previous test must fire again.
+        # This re-enables other tools' disabled locations too, which only
+        # costs them their next hit.
+        monitoring.restart_events()
+        monitoring.set_events(tool_id, monitoring.events.LINE)
+
+    def stop(self):
+        monitoring = sys.monitoring
+        tool_id = self._tool_id
+
+        if tool_id is None:
+            return
+
+        monitoring.set_events(tool_id, monitoring.events.NO_EVENTS)
+        monitoring.register_callback(tool_id, monitoring.events.LINE, None)
+        monitoring.free_tool_id(tool_id)
+        self._tool_id = None
+
+        for filename in self.find_source_files():
+            if self.is_measured(filename):
+                self.data.add_file(filename)
+
+    def find_source_files(self):
+        """
+        Yields the Python files in the `source` directories. Like coverage.py,
+        subdirectories are only searched if they are packages.
+        """
+        for pattern in self.source:
+            if not os.path.isdir(pattern):
+                continue
+
+            for dirpath, dirnames, filenames in os.walk(pattern):
+                if dirpath != pattern and '__init__.py' not in filenames:
+                    del dirnames[:]
+                    continue
+
+                for filename in filenames:
+                    if filename.endswith(('.py', '.pyw')):
+                        yield os.path.join(dirpath, filename)
+
+    def get_data(self):
+        return self.data
@@ -1,4 +1,5 @@
 import re
+import sys
 
 import yaml
 
@@ -15,14 +16,35 @@ class Config(object):
     `*` in each pattern optionally that matches anything. e.g. `*foobar*` will
     exclude any tests having `foobar` in its full path. `omit_tests` defaults
     to being empty if not specified.
+
+    For monorepos, specify `packages` as a list of package directories. The
+    influence map is then split into one shard per package, saved inside the
+    package and only loaded when a file in that package changes. `packages`
+    defaults to being empty, i.e. a single map for the whole tree.
+
+    `collector` picks what records the lines each test runs while mapping:
+    `monitoring` uses the much faster `sys.monitoring` (Python 3.12+),
+    `coverage` uses coverage.py and `auto`, the default, uses `monitoring`
+    where available and `coverage` otherwise.
     """
 
+    COLLECTORS = ('auto', 'monitoring', 'coverage')
+
     DEFAULT_FILENAME = '.codemonrc'
 
-    def __init__(self, omit=[], source='.', omit_tests=[]):
+    def __init__(self, omit=[], source='.', omit_tests=[], packages=[],
+                 collector='auto'):
         self.omit = omit or []
         self.source = source or '.'
         self.omit_tests = omit_tests or []
+        self.packages = packages or []
+        self.collector = collector or 'auto'
+
+        if self.collector not in self.COLLECTORS:
+            raise Exception('Unknown collector {}!'.format(self.collector))
+
+        if self.collector == 'monitoring' and not hasattr(sys, 'monitoring'):
+            raise Exception('The monitoring collector requires Python 3.12+!')
 
         # initialize omit_tests regex
         self.omit_tests = [self._regex_replacement(s) for s in self.omit_tests]
@@ -1,13 +1,21 @@
 from collections import defaultdict, OrderedDict
 
+import ast
+import difflib
+import hashlib
+import io
+import os
 import sys
+import tempfile
+import tokenize
+import zlib
 
 from msgpack.exceptions import UnpackValueError
 
 import msgpack
 
 
-__all__ = ['SourceMap']
+__all__ = ['SourceMap', 'ShardedSourceMap', 'ResultCache']
 
 
 class _SourceTestMap(defaultdict):
@@ -72,22 +80,94 @@ class SourceMap(OrderedDict):
     """SourceMap
 
     An OrderedDict of SourceTestMaps with a convenient interface.
+
+    Also keeps `coverage`, a reverse index of test name -> filename -> set of
+    line numbers, in sync so that per-test lookups and removals scale with
+    the test's footprint instead of the size of the map. Changes should go
+    through `SourceMap` rather than its SourceTestMaps to keep it in sync.
+
+    `layouts` keeps a checksum of the code on every line of each file as it
+    was when the file was mapped, so recorded line numbers can be followed to
+    where those lines have since moved.
     """
 
     DEFAULT_FILENAME = '.codemonmap'
 
+    def __init__(self, *args, **kwargs):
+        self.coverage = defaultdict(dict)
+        self.layouts = {}
+        super(SourceMap, self).__init__(*args, **kwargs)
+
     def __setitem__(self, filename, coverage_data):
         if not isinstance(coverage_data, tuple):
+            if filename in self:
+                self._unindex(filename)
+
             super(SourceMap, self).__setitem__(filename, coverage_data)
+            self._index(filename)
             return
 
         test_name, line_nums = coverage_data
+        line_nums = list(line_nums)
 
         self.touch(filename)
 
         for num in line_nums:
             self[filename].add(num, test_name)
 
+        if line_nums:
+            self.coverage[test_name].setdefault(filename, set()).update(
+                line_nums
+            )
+
+    def __delitem__(self, filename):
+        self._unindex(filename)
+        self.layouts.pop(filename, None)
+        super(SourceMap, self).__delitem__(filename)
+
+    def pop(self, filename, *default):
+        if filename in self:
+            self._unindex(filename)
+            self.layouts.pop(filename, None)
+
+        return super(SourceMap, self).pop(filename, *default)
+
+    def popitem(self, last=True):
+        filename, stm = super(SourceMap, self).popitem(last=last)
+
+        self._unindex(filename, stm)
+        self.layouts.pop(filename, None)
+
+        return filename, stm
+
+    def clear(self):
+        super(SourceMap, self).clear()
+        self.coverage.clear()
+        self.layouts.clear()
+
+    def _index(self, filename):
+        for line_num, test_names in self[filename].items():
+            for test_name in test_names:
+                self.coverage[test_name].setdefault(filename, set()).add(
+                    line_num
+                )
+
+    def _unindex(self, filename, stm=None):
+        if stm is None:
+            stm = self[filename]
+
+        for test_names in stm.values():
+            for test_name in test_names:
+                files = self.coverage.get(test_name)
+
+                if files is None:
+                    continue
+
+                files.pop(filename, None)
+
+                if not files:
+                    del self.coverage[test_name]
+
     @property
     def files(self):
         return self.keys()
@@ -121,16 +201,36 @@ class SourceMap(OrderedDict):
 
     @classmethod
     def deserialize(cls, serialized_data):
-        data, reverse_index = serialized_data
+        data, reverse_index = serialized_data[:2]
+
+        # maps saved before the reverse index was persisted get it rebuilt
+        coverage = serialized_data[2] if len(serialized_data) > 2 else None
+        layouts = serialized_data[3] if len(serialized_data) > 3 else {}
 
         new_obj = cls()
 
         for serialized_stm in data:
             filename, _ = serialized_stm
 
-            new_obj[filename] = _SourceTestMap.deserialize(
-                (serialized_stm, reverse_index)
-            )
+            stm = _SourceTestMap.deserialize((serialized_stm, reverse_index))
+
+            if coverage is None:
+                new_obj[filename] = stm
+            else:
+                super(SourceMap, new_obj).__setitem__(filename, stm)
+
+        if coverage is not None:
+            filenames = list(new_obj)
+
+            for test_index, files in coverage.items():
+                new_obj.coverage[reverse_index[test_index]] = {
+                    filenames[position]: set(line_nums)
+                    for position, line_nums in files.items()
+                }
+
+        filenames = list(new_obj)
+        for position, layout in layouts.items():
+            new_obj.layouts[filenames[position]] = list(layout)
 
         return new_obj
 
@@ -139,18 +239,84 @@ class SourceMap(OrderedDict):
         assert isinstance(instance, cls)
 
         testname_lookup = instance.index.copy()
+        file_positions = {}
 
         serialized_data = []
-        for filename, stm in instance.items():
+        for position, (filename, stm) in enumerate(instance.items()):
             serialized_data.append(
                 _SourceTestMap.serialize(stm, testname_lookup)
             )
+            file_positions[filename] = position
+
+        coverage = {
+            testname_lookup[test_name]: {
+                file_positions[filename]: sorted(line_nums)
+                for filename, line_nums in files.items()
+            }
+            for test_name, files in instance.coverage.items()
+            if test_name in testname_lookup
+        }
+
+        layouts = {
+            file_positions[filename]: layout
+            for filename, layout in instance.layouts.items()
+            if filename in file_positions
+        }
+
+        return (serialized_data, instance.reverse_index, coverage, layouts)
+
+    def discard(self, test_name):
+        """Removes every record of `test_name` from the map."""
+        for filename, line_nums in self.coverage.pop(test_name, {}).items():
+            stm = self[filename]
+
+            for line_num in line_nums:
+                tests = stm[line_num]
+                tests.discard(test_name)
 
-        return (serialized_data, instance.reverse_index)
+                if not tests:
+                    del stm[line_num]
+
+    def covered_lines(self, test_names):
+        """
+        Returns a dict mapping each of the given tests to a dict of
+        filename -> sorted list of line numbers covered by that test.
+        """
+        return {
+            test_name: {
+                filename: sorted(line_nums)
+                for filename, line_nums in self.coverage.get(test_name,
+                                                             {}).items()
+            }
+            for test_name in test_names
+        }
+
+    def fingerprints(self, test_names):
+        """
+        Returns a dict mapping each of the given tests to a digest of the
+        current code it depends on: the import-time statements of every file
+        it covers and the whole of every function it runs through.
+
+        Edits to comments, whitespace or functions the test never ran leave
+        its fingerprint untouched. Tests whose covered lines were removed or
+        rewritten along with others since they were mapped get None, as there
+        is no telling what they would run through now.
+        """
+        return _fingerprints(self.covered_lines(test_names), self.layouts)
+
+    def refresh_layouts(self, filenames=None):
+        """Records the current layout of files that were just re-mapped."""
+        if filenames is None:
+            filenames = self.files
+
+        for filename in filenames:
+            if filename in self:
+                self.layouts[filename] = _layout(_read_lines(filename))
 
     def touch(self, filename):
         if filename not in self:
             self[filename] = _SourceTestMap(filename)
+            self.layouts[filename] = _layout(_read_lines(filename))
 
     @classmethod
     def write_to_file(cls, instance, filename=None):
@@ -159,9 +325,8 @@ class SourceMap(OrderedDict):
         output = '[CODEMON] Saving influence map to file {}\n\n'
         sys.stdout.write(output.format(filename))
 
-        with open(filename, 'wb') as f:
-            f.write(msgpack.packb(cls.serialize(instance),
-                                  use_bin_type=True))
+        _write_file(filename, msgpack.packb(cls.serialize(instance),
+                                            use_bin_type=True))
 
     @classmethod
     def read_from_file(cls, filename=None):
@@ -169,8 +334,568 @@ class SourceMap(OrderedDict):
 
         try:
             with open(filename, 'rb') as f:
-                source_map = msgpack.unpackb(f.read())
+                source_map = _unpackb(f.read())
 
             return cls.deserialize(source_map)
         except (IOError, EOFError, UnpackValueError):
             return cls()
+
+
+class ShardedSourceMap(object):
+    """ShardedSourceMap
+
+    A SourceMap split into one shard per package root, for monorepos.
+
+    Each shard is a SourceMap saved as `.codemonmap` inside its package and is
+    only read from disk once a file in that package is looked up. Files
+    outside of every package go to the top-level shard.
+
+    A top-level index, saved as `.codemonindex`, keeps filename -> package
+    root to route files to their shards and list the files to watch, test
+    name -> package roots it covers so per-test lookups load exactly the
+    shards the test covers, and the untested files. None of these need a
+    shard to be loaded.
+    """
+
+    INDEX_FILENAME = '.codemonindex'
+    TOP_LEVEL = ''
+
+    def __init__(self, roots, index=None, test_roots=None, untested=None):
+        # longest roots first so nested packages win over their parents
+        self.roots = sorted((os.path.abspath(root) for root in roots),
+                            key=len, reverse=True)
+        self.index = index or {}
+        self.test_roots = defaultdict(set)
+        self.untested = set(untested or [])
+        self.shards = {}
+
+        for test_name, test_roots in (test_roots or {}).items():
+            self.test_roots[test_name].update(test_roots)
+
+    def root_for(self, filename):
+        filename = os.path.abspath(filename)
+
+        for root in self.roots:
+            if filename == root or filename.startswith(root + os.sep):
+                return root
+
+        return self.TOP_LEVEL
+
+    def route(self, filename):
+        """
+        Returns the root of the shard `filename` belongs to under the current
+        roots, first moving its entries there if it was indexed under another
+        root, e.g. before its package was added to the config.
+        """
+        root = self.root_for(filename)
+        indexed_root = self.index.get(filename)
+
+        if indexed_root is not None and indexed_root != root:
+            self._move(filename, indexed_root, root)
+
+        return root
+
+    def _move(self, filename, old_root, new_root):
+        old_shard = self.shard(old_root)
+        new_shard = self.shard(new_root)
+
+        self.index[filename] = new_root
+
+        if filename not in old_shard:
+            return
+
+        layout = old_shard.layouts.get(filename)
+        stm = old_shard.pop(filename)
+
+        new_shard[filename] = stm
+        new_shard.layouts[filename] = layout
+
+        for test_name in stm.all_affected_tests:
+            self.test_roots[test_name].add(new_root)
+
+            # the test may still cover other files in the old shard
+            if test_name not in old_shard.coverage:
+                self.test_roots[test_name].discard(old_root)
+
+    @classmethod
+    def shard_filename(cls, root):
+        if root == cls.TOP_LEVEL:
+            return SourceMap.DEFAULT_FILENAME
+
+        return os.path.join(root, SourceMap.DEFAULT_FILENAME)
+
+    def shard(self, root):
+        """Returns the shard for `root`, loading it from disk if needed."""
+        if root not in self.shards:
+            self.shards[root] = SourceMap.read_from_file(
+                self.shard_filename(root)
+            )
+
+        return self.shards[root]
+
+    def rebuild_index(self):
+        """Rebuilds the per-test index from every shard. Loads all of them."""
+        self.test_roots.clear()
+        self.untested.clear()
+
+        for root in set(self.index.values()):
+            shard = self.shard(root)
+
+            for test_name in shard.coverage:
+                self.test_roots[test_name].add(root)
+
+            self.untested.update(shard.untested_files)
+
+    def _update_untested(self, filename, shard):
+        if filename in shard and shard[filename].is_untested:
+            self.untested.add(filename)
+        else:
+            self.untested.discard(filename)
+
+    def __getitem__(self, filename):
+        return self.shard(self.route(filename))[filename]
+
+    def __setitem__(self, filename, coverage_data):
+        root = self.route(filename)
+        shard = self.shard(root)
+
+        self.index[filename] = root
+        shard[filename] = coverage_data
+
+        if isinstance(coverage_data, tuple):
+            test_name, line_nums = coverage_data
+            test_names = [test_name] if line_nums else []
+        else:
+            test_names = coverage_data.all_affected_tests
+
+        for test_name in test_names:
+            self.test_roots[test_name].add(root)
+
+        self._update_untested(filename, shard)
+
+    def __contains__(self, filename):
+        return filename in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    def touch(self, filename):
+        root = self.route(filename)
+        shard = self.shard(root)
+
+        self.index[filename] = root
+        shard.touch(filename)
+        self._update_untested(filename, shard)
+
+    @property
+    def files(self):
+        return list(self.index)
+
+    @property
+    def untested_files(self):
+        return list(self.untested)
+
+    def suite(self, filenames=None):
+        """
+        Returns a set of all related tests for a given list of source files,
+        loading only the shards those files belong to.
+        """
+        filenames = filenames or self.files
+
+        tests = set()
+
+        for filename in filenames:
+            shard = self.shard(self.route(filename))
+
+            if filename in shard:
+                tests.update(shard[filename].all_affected_tests)
+
+        return tests
+
+    def discard(self, test_name):
+        for root in self.test_roots.pop(test_name, ()):
+            shard = self.shard(root)
+            filenames = list(shard.coverage.get(test_name, {}))
+
+            shard.discard(test_name)
+
+            for filename in filenames:
+                self._update_untested(filename, shard)
+
+    def covered_lines(self, test_names):
+        """
+        Like `SourceMap.covered_lines`, loading exactly the shards each test
+        covers.
+        """
+        covered = {}
+
+        for test_name in test_names:
+            covered[test_name] = {}
+
+            for root in self.test_roots.get(test_name, ()):
+                covered[test_name].update(
+                    self.shard(root).covered_lines([test_name])[test_name]
+                )
+
+        return covered
+
+    def fingerprints(self, test_names):
+        covered_lines = self.covered_lines(test_names)
+
+        layouts = {}
+        for files in covered_lines.values():
+            for filename in files:
+                if filename not in layouts:
+                    shard = self.shard(self.route(filename))
+                    layouts[filename] = shard.layouts.get(filename)
+
+        return _fingerprints(covered_lines, layouts)
+
+    def refresh_layouts(self, filenames=None):
+        if filenames is None:
+            filenames = self.files
+
+        for filename in filenames:
+            self.shard(self.route(filename)).refresh_layouts([filename])
+
+    @classmethod
+    def serialize(cls, instance):
+        assert isinstance(instance, cls)
+
+        test_roots = {test_name: sorted(roots)
+                      for test_name, roots in instance.test_roots.items()
+                      if roots}
+
+        return (instance.index, test_roots, sorted(instance.untested))
+
+    @classmethod
+    def deserialize(cls, roots, serialized_data):
+        # indexes saved before tests were indexed only map files to roots
+        if isinstance(serialized_data, dict):
+            new_obj = cls(roots, index=serialized_data)
+            new_obj.rebuild_index()
+            return new_obj
+
+        index, test_roots, untested = serialized_data
+
+        return cls(roots, index=index, test_roots=test_roots,
+                   untested=untested)
+
+    @classmethod
+    def write_to_file(cls, instance, filename=None):
+        """Saves the index and every loaded shard."""
+        filename = filename or cls.INDEX_FILENAME
+
+        for root, shard in instance.shards.items():
+            SourceMap.write_to_file(shard, cls.shard_filename(root))
+
+        _write_file(filename, msgpack.packb(cls.serialize(instance),
+                                            use_bin_type=True))
+
+    @classmethod
+    def read_from_file(cls, roots, filename=None):
+        """Reads the index only; shards are loaded as they are needed."""
+        filename = filename or cls.INDEX_FILENAME
+
+        try:
+            with open(filename, 'rb') as f:
+                serialized_data = _unpackb(f.read())
+
+            return cls.deserialize(roots, serialized_data)
+        except (IOError, EOFError, UnpackValueError):
+            return cls(roots)
+
+
+class ResultCache(dict):
+    """ResultCache
+
+    dict where:
+        key:    test name
+        value:  (fingerprint, outcome) of the last run of the test
+    """
+
+    DEFAULT_FILENAME = '.codemoncache'
+
+    def record(self, test_name, fingerprint, outcome):
+        self[test_name] = (fingerprint, outcome)
+
+    def lookup(self, test_name, fingerprint):
+        """
+        Returns a tuple of (hit, outcome). `hit` is True only if the test was
+        last run against the same fingerprint.
+        """
+        cached = self.get(test_name)
+
+        if fingerprint is None or cached is None or cached[0] != fingerprint:
+            return False, None
+
+        return True, cached[1]
+
+    @classmethod
+    def serialize(cls, instance):
+        assert isinstance(instance, cls)
+
+        return {test_name: list(entry) for test_name, entry in instance.items()}
+
+    @classmethod
+    def deserialize(cls, serialized_data):
+        new_obj = cls()
+
+        for test_name, (fingerprint, outcome) in serialized_data.items():
+            new_obj.record(test_name, fingerprint, outcome)
+
+        return new_obj
+
+    @classmethod
+    def write_to_file(cls, instance, filename=None):
+        filename = filename or cls.DEFAULT_FILENAME
+
+        _write_file(filename, msgpack.packb(cls.serialize(instance),
+                                            use_bin_type=True))
+
+    @classmethod
+    def read_from_file(cls, filename=None):
+        filename = filename or cls.DEFAULT_FILENAME
+
+        try:
+            with open(filename, 'rb') as f:
+                result_cache = _unpackb(f.read())
+
+            return cls.deserialize(result_cache)
+        except (IOError, EOFError, UnpackValueError):
+            return cls()
+
+
+def _unpackb(packed):
+    try:
+        # msgpack >= 1.0 refuses non-string map keys, e.g. line numbers
+        return msgpack.unpackb(packed, strict_map_key=False)
+    except TypeError:
+        return msgpack.unpackb(packed)
+
+
+def _write_file(filename, data):
+    """
+    Writes `data` to a temporary file that is then moved over `filename`, so
+    readers and concurrent writers never see a half-written file.
+    """
+    fd, temp_filename = tempfile.mkstemp(
+        dir=os.path.dirname(os.path.abspath(filename)),
+        prefix=os.path.basename(filename) + '.'
+    )
+
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+
+        # os.replace is Python 3.3+, os.rename only overwrites on POSIX
+        getattr(os, 'replace', os.rename)(temp_filename, filename)
+    except BaseException:
+        os.remove(temp_filename)
+        raise
+
+
+def _read_lines(filename):
+    try:
+        with open(filename, 'rb') as f:
+            return f.read().splitlines()
+    except IOError:
+        # file deleted
+        return []
+
+
+_NON_CODE_TOKENS = frozenset([
+    tokenize.COMMENT, tokenize.NL, tokenize.NEWLINE, tokenize.INDENT,
+    tokenize.DEDENT, tokenize.ENDMARKER,
+])
+
+
+class _SourceFile(object):
+    """_SourceFile
+
+    The code of a source file, split into what a test's fingerprint is made
+    of: the file's `skeleton`, i.e. the statements that run when it is
+    imported (module and class bodies, decorators and function signatures),
+    and the body of each function.
+
+    Code is compared token by token, so comments and whitespace are ignored.
+    Raises SyntaxError if the file cannot be parsed.
+    """
+
+    def __init__(self, lines):
+        text = b'\n'.join(lines).decode('utf-8', 'replace') + u'\n'
+
+        self.code = defaultdict(list)
+
+        try:
+            tokens = list(tokenize.generate_tokens(io.StringIO(text).readline))
+        except tokenize.TokenError as e:
+            raise SyntaxError(str(e))
+
+        for token in tokens:
+            token_type, string, (start, _), (end, _) = token[:4]
+
+            if token_type in _NON_CODE_TOKENS:
+                continue
+
+            # strings spanning several lines count as code on each of them
+            for line_num in range(start, end + 1):
+                self.code[line_num].append(string)
+
+        # (first line, last line) of each function body
+        self.scopes = []
+        _collect_scopes(ast.parse(text).body, self.scopes)
+
+        self.scope_by_line = {}
+        for scope in self.scopes:
+            for line_num in range(scope[0], scope[1] + 1):
+                self.scope_by_line[line_num] = scope
+
+        self.skeleton = self.source(
+            line_num for line_num in sorted(self.code)
+            if line_num not in self.scope_by_line
+        )
+
+        # a checksum of the code on each line, 0 for lines with no code
+        self.layout = [
+            zlib.crc32(self.source([line_num])) & 0xffffffff or 1
+            if self.code.get(line_num) else 0
+            for line_num in range(1, len(lines) + 1)
+        ]
+
+    def source(self, line_nums):
+        return u' '.join(string
+                         for line_num in line_nums
+                         for string in self.code.get(line_num, [])
+                         ).encode('utf-8')
+
+    def scope_source(self, scope):
+        return self.source(range(scope[0], scope[1] + 1))
+
+
+_FUNCTION_DEFS = tuple(getattr(ast, name)
+                       for name in ('FunctionDef', 'AsyncFunctionDef')
+                       if hasattr(ast, name))
+
+
+def _collect_scopes(statements, scopes):
+    for node in statements:
+        if isinstance(node, _FUNCTION_DEFS):
+            first = node.body[0].lineno
+            last = _end_lineno(node)
+
+            # one-line functions are left in the skeleton whole
+            if first > node.lineno:
+                scopes.append((first, last))
+            continue
+
+        for field in ('body', 'orelse', 'finalbody', 'handlers'):
+            _collect_scopes(getattr(node, field, None) or [], scopes)
+
+
+def _end_lineno(node):
+    end_lineno = getattr(node, 'end_lineno', None)
+
+    if end_lineno is None:
+        # Python < 3.8 doesn't record where a statement ends
+        end_lineno = max(getattr(child, 'lineno', 0)
+                         for child in ast.walk(node))
+
+    return end_lineno
+
+
+def _parse(lines):
+    try:
+        return _SourceFile(lines)
+    except (SyntaxError, ValueError):
+        return None
+
+
+def _layout(lines):
+    source_file = _parse(lines)
+
+    return None if source_file is None else source_file.layout
+
+
+def _line_translation(mapped, current):
+    """
+    Returns a dict mapping line numbers recorded against the `mapped` layout
+    to where those lines are in the `current` one, for the lines of code that
+    are unchanged or were edited in place. Lines added or removed around them,
+    such as comments, just shift them.
+    """
+    old = [(line_num, checksum)
+           for line_num, checksum in enumerate(mapped, 1) if checksum]
+    new = [(line_num, checksum)
+           for line_num, checksum in enumerate(current, 1) if checksum]
+
+    matcher = difflib.SequenceMatcher(None,
+                                      [checksum for _, checksum in old],
+                                      [checksum for _, checksum in new],
+                                      autojunk=False)
+    translation = {}
+
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == 'equal' or (tag == 'replace' and i2 - i1 == j2 - j1):
+            for offset in range(i2 - i1):
+                translation[old[i1 + offset][0]] = new[j1 + offset][0]
+
+    return translation
+
+
+def _fingerprints(covered_lines, layouts):
+    source_files = {}
+    translations = {}
+    fingerprints = {}
+
+    for test_name, files in covered_lines.items():
+        digest = hashlib.sha1()
+        stale = False
+
+        for filename in sorted(files):
+            if filename not in source_files:
+                source_file = _parse(_read_lines(filename))
+                mapped = layouts.get(filename)
+
+                source_files[filename] = source_file
+                if (source_file is not None and mapped is not None and
+                        mapped != source_file.layout):
+                    translations[filename] = _line_translation(
+                        mapped, source_file.layout
+                    )
+
+            source_file = source_files[filename]
+            translation = translations.get(filename)
+
+            if source_file is None or layouts.get(filename) is None:
+                stale = True
+                break
+
+            scopes = set()
+            for line_num in files[filename]:
+                if translation is not None:
+                    line_num = translation.get(line_num)
+
+                if line_num is None:
+                    # the line was removed or rewritten along with others
+                    stale = True
+                    break
+
+                scope = source_file.scope_by_line.get(line_num)
+                if scope is not None:
+                    scopes.add(scope)
+
+            if stale:
+                break
+
+            header = u'{}:'.format(filename)
+            digest.update(header.encode('utf-8'))
+            digest.update(source_file.skeleton)
+
+            for scope in sorted(scopes):
+                digest.update(b'\0')
+                digest.update(source_file.scope_source(scope))
+
+        fingerprints[test_name] = None if stale else digest.hexdigest()
+
+    return fingerprints
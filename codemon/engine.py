@@ -0,0 +1,328 @@
+import asyncio
+import hashlib
+import sys
+import threading
+import traceback
+
+from .codemon import Codemon
+from .datastructures import ResultCache
+from .watcher import Watcher
+
+
+__all__ = ['AsyncCodemon']
+
+
+class AsyncCodemon(Codemon):
+    """AsyncCodemon
+
+    An asyncio-based `Codemon`. Watching files for changes, debouncing the
+    changes, running the affected tests and persisting the influence map run
+    as concurrent tasks on a single event loop.
+
+    Tests are run in subprocesses with async I/O if the mapper implements
+    `test_command`, up to `concurrency` at a time. Otherwise `test_suite` is
+    run in a worker thread.
+
+    If `remap` is set, tests are re-mapped after they are run so the influence
+    map keeps up with edits that move lines around.
+
+    Use `serve` to embed codemon in an existing event loop, or `run` to block
+    until interrupted.
+    """
+
+    def __init__(self, config=None, mapper_class=None, map_only=False,
+                 use_cached=False, verbosity=1, frequency=2, debounce=0.5,
+                 concurrency=4, remap=False):
+        super(AsyncCodemon, self).__init__(config=config,
+                                           mapper_class=mapper_class,
+                                           map_only=map_only,
+                                           use_cached=use_cached,
+                                           verbosity=verbosity)
+        self.frequency = frequency
+        self.debounce = debounce
+        self.concurrency = concurrency
+        self.remap = remap
+
+        # guards the source map, which is mutated in worker threads
+        self._map_lock = threading.Lock()
+        # orders writes of the result cache from `_persist` and `serve`
+        self._cache_lock = threading.Lock()
+        self._map_changed = False
+        self._stopping = None
+        self._dirty = None
+
+    def run(self):
+        try:
+            asyncio.run(self.serve())
+        except KeyboardInterrupt:
+            sys.exit(0)
+
+    def stop(self):
+        """Asks `serve` to shut down. Must be called from the event loop."""
+        if self._stopping is not None:
+            self._stopping.set()
+
+    async def serve(self):
+        loop = asyncio.get_running_loop()
+        self._stopping = asyncio.Event()
+        self._dirty = asyncio.Event()
+
+        await loop.run_in_executor(None, self.mapper.run)
+
+        if self.map_only:
+            return
+
+        self.watcher = Watcher(list(self.mapper.files),
+                               verbosity=self.verbosity,
+                               callback=None)
+
+        changes = asyncio.Queue()
+        batches = asyncio.Queue()
+
+        tasks = [
+            asyncio.ensure_future(self._watch(changes)),
+            asyncio.ensure_future(self._debounce(changes, batches)),
+            asyncio.ensure_future(self._schedule(batches)),
+            asyncio.ensure_future(self._persist()),
+        ]
+        stopping = asyncio.ensure_future(self._stopping.wait())
+
+        if self.verbosity >= 2:
+            sys.stdout.write('\n[CODEMON] Watcher is now watching your code...\n')
+
+        try:
+            done, _ = await asyncio.wait(tasks + [stopping],
+                                         return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for task in tasks + [stopping]:
+                task.cancel()
+            await asyncio.gather(*tasks + [stopping], return_exceptions=True)
+            await self._save()
+
+        for task in done:
+            if task is not stopping:
+                task.result()
+
+    async def _watch(self, changes):
+        while True:
+            await asyncio.sleep(self.frequency)
+
+            # stat-ing every mapped file is blocking I/O
+            changed_files = await asyncio.get_running_loop().run_in_executor(
+                None, self.watcher.changed_files
+            )
+
+            for filename in changed_files:
+                changes.put_nowait(filename)
+
+    async def _debounce(self, changes, batches):
+        """Groups changes that arrive within `debounce` seconds of another."""
+        while True:
+            pending = set([await changes.get()])
+
+            while True:
+                try:
+                    filename = await asyncio.wait_for(changes.get(),
+                                                      self.debounce)
+                except asyncio.TimeoutError:
+                    break
+                pending.add(filename)
+
+            batches.put_nowait(sorted(pending))
+
+    async def _schedule(self, batches):
+        while True:
+            filenames = set(await batches.get())
+
+            # coalesce batches that queued up while the last run was going
+            while not batches.empty():
+                filenames.update(batches.get_nowait())
+
+            try:
+                await self.run_affected_tests(sorted(filenames))
+            except Exception:
+                sys.stdout.write('[CODEMON] Error running tests:\n')
+                sys.stdout.write(traceback.format_exc())
+
+    async def _persist(self):
+        while True:
+            await self._dirty.wait()
+            self._dirty.clear()
+            await self._save()
+
+    async def _save(self):
+        loop = asyncio.get_running_loop()
+
+        self._dirty.clear()
+        await loop.run_in_executor(None, self._write_result_cache)
+
+        if self._map_changed:
+            self._map_changed = False
+            await loop.run_in_executor(None, self._write_source_map)
+
+    def _write_result_cache(self):
+        # a write from a cancelled `_persist` can still be running in its
+        # thread. Copying the cache once holding the lock makes the last
+        # write the most recent one.
+        with self._cache_lock:
+            ResultCache.write_to_file(ResultCache(self.mapper.result_cache))
+
+    def _write_source_map(self):
+        with self._map_lock:
+            self.mapper.write_source_map()
+
+    def _partition_suite(self, filenames):
+        """
+        Returns `partition_suite`'s tuple, plus a checksum of each file
+        covered by the tests to run, as partitioning saw them.
+        """
+        with self._map_lock:
+            tests_to_run, cached_results, fingerprints = \
+                self.mapper.partition_suite(filenames)
+            covered_lines = self.mapper.source_map.covered_lines(tests_to_run)
+
+        checksums = {}
+        if self.remap:
+            checksums = _checksums({filename
+                                    for files in covered_lines.values()
+                                    for filename in files})
+
+        return tests_to_run, cached_results, fingerprints, checksums
+
+    def _remap_tests(self, tests, checksums):
+        """
+        Re-maps `tests` and returns their new fingerprints.
+
+        A file saved while the tests ran is re-mapped as it is now, but the
+        tests' outcomes are from before. Tests covering a file that changed
+        since `checksums` were taken get None, so their outcome isn't cached
+        against code it was not run with.
+        """
+        with self._map_lock:
+            self.mapper.remap_tests(tests)
+            fingerprints = self.mapper.source_map.fingerprints(tests)
+            covered_lines = self.mapper.source_map.covered_lines(tests)
+
+        current = _checksums({filename
+                              for files in covered_lines.values()
+                              for filename in files})
+
+        for test_name, files in covered_lines.items():
+            if any(filename not in checksums or
+                   checksums[filename] != current[filename]
+                   for filename in files):
+                fingerprints[test_name] = None
+
+        return fingerprints
+
+    async def run_affected_tests(self, filenames):
+        loop = asyncio.get_running_loop()
+        mapper = self.mapper
+
+        tests_to_run, cached_results, fingerprints, checksums = \
+            await loop.run_in_executor(None, self._partition_suite, filenames)
+
+        mapper.report_affected_tests(filenames, tests_to_run, cached_results)
+
+        results = {}
+        if tests_to_run:
+            commands = {test_name: mapper.test_command(test_name)
+                        for test_name in tests_to_run}
+
+            if all(commands.values()):
+                results = await self.run_test_commands(commands)
+            else:
+                results = await loop.run_in_executor(None, mapper.test_suite,
+                                                     tests_to_run)
+                results = dict(results or {})
+
+        if self.remap and tests_to_run:
+            fingerprints = await loop.run_in_executor(None, self._remap_tests,
+                                                      tests_to_run, checksums)
+            self.watcher.filenames = list(mapper.files)
+            self._map_changed = True
+            self._dirty.set()
+
+        mapper.record_results(results, fingerprints)
+
+        if results:
+            self._dirty.set()
+
+        results.update(cached_results)
+        return results
+
+    async def run_test_commands(self, commands):
+        """
+        Runs each test's command in a subprocess, at most `concurrency` at a
+        time. Returns a dict of test name -> whether the test passed.
+
+        Tests whose command could not be run are reported and left out of the
+        results, so they are not cached and run again next time.
+        """
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def run_one(test_name, command):
+            async with semaphore:
+                try:
+                    process = await asyncio.create_subprocess_exec(
+                        *command,
+                        stdout=asyncio.subprocess.PIPE,
+                        stderr=asyncio.subprocess.STDOUT
+                    )
+                except asyncio.CancelledError:
+                    raise
+                except Exception:
+                    output_message = '[CODEMON] ERROR {test_name}\n'.format(
+                        test_name=test_name
+                    )
+                    output_message += traceback.format_exc()
+                    sys.stdout.write(output_message)
+                    return test_name, None
+
+                try:
+                    output, _ = await process.communicate()
+                finally:
+                    if process.returncode is None:
+                        process.kill()
+                        await process.wait()
+
+            passed = process.returncode == 0
+
+            if self.verbosity >= 2 or not passed:
+                output_message = '[CODEMON] {status} {test_name}\n'.format(
+                    status='PASS' if passed else 'FAIL',
+                    test_name=test_name
+                )
+                output_message += output.decode('utf-8', 'replace')
+                sys.stdout.write(output_message)
+
+            return test_name, passed
+
+        tasks = [asyncio.ensure_future(run_one(test_name, command))
+                 for test_name, command in sorted(commands.items())]
+
+        try:
+            results = await asyncio.gather(*tasks)
+        finally:
+            # if one of them fails, the others' processes are killed too
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+        return {test_name: passed
+                for test_name, passed in results
+                if passed is not None}
+
+
+def _checksums(filenames):
+    checksums = {}
+
+    for filename in filenames:
+        try:
+            with open(filename, 'rb') as f:
+                checksums[filename] = hashlib.sha1(f.read()).hexdigest()
+        except IOError:
+            # file deleted
+            checksums[filename] = None
+
+    return checksums
@@ -75,17 +75,16 @@ class Watcher(object):
         except KeyboardInterrupt:
             sys.exit(0)
 
-    def test_if_changed(self):
+    def changed_files(self):
+        """
+        Returns the list of files that have changed since the last call.
+        """
         changed_files = []
 
         for filename in self.filenames:
             if not filename:
                 raise Exception('Got a falsy filename!')
 
-            prev_time = self.mtimes.get(filename, 0)
-            if prev_time is None:
-                continue
-
             try:
                 mtime = os.stat(filename).st_mtime
             except OSError:
@@ -95,8 +94,15 @@ class Watcher(object):
             if filename not in self.mtimes:
                 self.mtimes[filename] = mtime
             elif mtime != self.mtimes[filename]:
+                # remember the new mtime so that changes made right after
+                # this one are not missed
+                self.mtimes[filename] = mtime
                 changed_files.append(filename)
 
+        return changed_files
+
+    def test_if_changed(self):
+        changed_files = self.changed_files()
+
         if len(changed_files) > 0:
-            self.mtimes = {}
             self.callback(changed_files)
@@ -0,0 +1,202 @@
+from unittest import TestCase
+
+import os
+import shutil
+import tempfile
+
+from coverage import Coverage
+
+from codemon.codemon import InfluenceMapper
+from codemon.collector import LineCollector, LineData
+from codemon.config import Config
+from codemon.datastructures import ResultCache
+
+
+class StubMapper(InfluenceMapper):
+    def setup(self):
+        self.runs = []
+        self.outcomes = {}
+
+    def test_suite(self, suite):
+        self.runs.append(set(suite))
+
+        if self.outcomes is None:
+            return None
+
+        return {test_name: self.outcomes.get(test_name, True)
+                for test_name in suite}
+
+
+class TestRunAffectedTests(TestCase):
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.tmpdir = tempfile.mkdtemp()
+        os.chdir(self.tmpdir)
+
+        self.filename = os.path.join(self.tmpdir, 'mod.py')
+        self.write_source(['def f():', '    return 1'])
+
+        self.mapper = StubMapper(config=Config())
+        self.mapper.setup()
+        self.mapper.source_map[self.filename] = ('test_f', [1, 2])
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.tmpdir)
+
+    def write_source(self, lines):
+        with open(self.filename, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+
+    def run_affected_tests(self):
+        return self.mapper.run_affected_tests([self.filename])
+
+    def test_unchanged_test_is_skipped(self):
+        self.mapper.outcomes = {'test_f': False}
+
+        self.assertEqual(self.run_affected_tests(), {'test_f': False})
+        self.assertEqual(self.run_affected_tests(), {'test_f': False})
+
+        self.assertEqual(self.mapper.runs, [{'test_f'}])
+
+    def test_results_are_saved(self):
+        self.run_affected_tests()
+
+        result_cache = ResultCache.read_from_file()
+        self.assertEqual(list(result_cache), ['test_f'])
+
+    def test_changed_covered_line_reruns_test(self):
+        self.run_affected_tests()
+        self.write_source(['def f():', '    return 2'])
+        self.run_affected_tests()
+
+        self.assertEqual(len(self.mapper.runs), 2)
+
+    def test_no_outcomes_are_not_cached(self):
+        self.mapper.outcomes = None
+
+        self.assertEqual(self.run_affected_tests(), {})
+        self.assertEqual(self.run_affected_tests(), {})
+
+        self.assertEqual(len(self.mapper.runs), 2)
+        self.assertFalse(os.path.exists(ResultCache.DEFAULT_FILENAME))
+
+    def test_changed_default_argument_reruns_test(self):
+        self.write_source(['def f(x, y=1):', '    return x + y'])
+        self.mapper.source_map.refresh_layouts()
+        self.mapper.source_map.discard('test_f')
+        self.mapper.source_map[self.filename] = ('test_f', [2])
+        self.run_affected_tests()
+
+        self.write_source(['def f(x, y=5):', '    return x + y'])
+        self.run_affected_tests()
+
+        self.assertEqual(len(self.mapper.runs), 2)
+
+    def test_shifted_lines_are_cached(self):
+        self.run_affected_tests()
+
+        self.write_source(['# header', 'def f():', '    return 1'])
+        self.run_affected_tests()
+
+        self.write_source(['# header', 'def f():', '    return 42'])
+        self.run_affected_tests()
+
+        self.assertEqual(len(self.mapper.runs), 2)
+
+    def test_rewritten_lines_are_not_cached_until_remapped(self):
+        self.run_affected_tests()
+
+        # the line `test_f` ran is now split across two
+        self.write_source(['def f():', '    return (', '        1)'])
+        self.run_affected_tests()
+        self.run_affected_tests()
+
+        self.assertEqual(len(self.mapper.runs), 3)
+
+        # once re-mapped, unchanged tests are skipped again
+        self.mapper.source_map.discard('test_f')
+        self.mapper.source_map[self.filename] = ('test_f', [1, 2])
+        self.mapper.source_map.refresh_layouts([self.filename])
+
+        self.run_affected_tests()
+        self.run_affected_tests()
+
+        self.assertEqual(len(self.mapper.runs), 4)
+
+
+    def test_failed_remap_keeps_the_map(self):
+        mapper = FailingMapper(config=Config())
+        mapper.source_map[self.filename] = ('test_f', [1, 2])
+
+        self.assertEqual(mapper.remap_tests(['test_f']), set())
+        self.assertEqual(mapper.source_map.suite([self.filename]),
+                         {'test_f'})
+
+
+class StubCollector(object):
+    def __init__(self):
+        self.started = False
+        self.stopped = False
+
+    def start(self):
+        self.started = True
+
+    def stop(self):
+        self.stopped = True
+
+    def get_data(self):
+        return LineData()
+
+
+class FailingMapper(InfluenceMapper):
+    def make_collector(self):
+        self.collector = StubCollector()
+        return self.collector
+
+    def map_test(self, test_name):
+        raise ValueError(test_name)
+
+
+class TestCollectors(TestCase):
+    def setUp(self):
+        self.is_available = LineCollector.__dict__['is_available']
+        self.is_supported = LineCollector.__dict__['is_supported']
+        self.mapper = StubMapper(config=Config())
+
+    def tearDown(self):
+        LineCollector.is_available = self.is_available
+        LineCollector.is_supported = self.is_supported
+
+    def set_available(self, available):
+        LineCollector.is_available = classmethod(lambda cls: available)
+        LineCollector.is_supported = classmethod(lambda cls: available)
+
+    def test_auto_uses_monitoring_when_available(self):
+        self.set_available(True)
+        self.assertIsInstance(self.mapper.make_collector(), LineCollector)
+
+    def test_auto_falls_back_to_coverage(self):
+        self.set_available(False)
+        self.assertIsInstance(self.mapper.make_collector(), Coverage)
+
+    def test_explicit_collectors(self):
+        self.mapper.config = Config(collector='coverage')
+        self.assertIsInstance(self.mapper.make_collector(), Coverage)
+
+        self.mapper.config.collector = 'monitoring'
+
+        if LineCollector.is_supported():
+            self.assertIsInstance(self.mapper.make_collector(), LineCollector)
+        else:
+            with self.assertRaises(Exception):
+                self.mapper.make_collector()
+
+    def test_run_coverage_stops_collector_on_error(self):
+        mapper = FailingMapper(config=Config())
+
+        with self.assertRaises(ValueError):
+            mapper.run_coverage('test_f')
+
+        self.assertTrue(mapper.collector.started)
+        self.assertTrue(mapper.collector.stopped)
@@ -0,0 +1,152 @@
+from unittest import TestCase, skipUnless
+
+import os
+import shutil
+import sys
+import tempfile
+
+from codemon.collector import LineCollector, LineData
+
+
+class TestLineData(TestCase):
+    def setUp(self):
+        self.obj = LineData()
+        self.obj.add_line('foo.py', 3)
+        self.obj.add_line('foo.py', 1)
+        self.obj.add_line('foo.py', 3)
+
+    def test_lines(self):
+        self.assertEqual(self.obj.lines('foo.py'), [1, 3])
+        self.assertEqual(self.obj.lines('bar.py'), [])
+
+    def test_measured_files(self):
+        self.assertEqual(self.obj.measured_files(), ['foo.py'])
+
+    def test_add_file(self):
+        self.obj.add_file('foo.py')
+        self.obj.add_file('bar.py')
+
+        self.assertEqual(sorted(self.obj.measured_files()),
+                         ['bar.py', 'foo.py'])
+        self.assertEqual(self.obj.lines('foo.py'), [1, 3])
+        self.assertEqual(self.obj.lines('bar.py'), [])
+
+
+class TestLineCollector(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.source_dir = os.path.join(self.tmpdir, 'src')
+        os.makedirs(os.path.join(self.source_dir, 'migrations'))
+
+        self.filename = self.write_module('target.py', [
+            'def target(x):',
+            '    if x:',
+            '        return 1',
+            '    return 2',
+        ])
+        self.write_module('migrations/__init__.py', [])
+        self.omitted = self.write_module('migrations/omitted.py', ['x = 1'])
+        self.unused = self.write_module('unused.py', ['x = 1'])
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def write_module(self, name, lines):
+        filename = os.path.join(self.source_dir, name)
+
+        with open(filename, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+
+        return filename
+
+    def make_collector(self):
+        return LineCollector(source=[self.source_dir],
+                             omit=['*/migrations/*'])
+
+    def load(self, filename):
+        namespace = {}
+
+        with open(filename) as f:
+            code = compile(f.read(), filename, 'exec')
+
+        exec(code, namespace)
+        return namespace
+
+    def test_is_measured(self):
+        collector = self.make_collector()
+
+        self.assertTrue(collector.is_measured(self.filename))
+        self.assertFalse(collector.is_measured(self.omitted))
+        self.assertFalse(collector.is_measured(__file__))
+        self.assertFalse(collector.is_measured('<string>'))
+
+    def test_find_source_files(self):
+        os.makedirs(os.path.join(self.source_dir, 'pkg'))
+        os.makedirs(os.path.join(self.source_dir, 'scripts'))
+        package = self.write_module('pkg/__init__.py', [])
+        module = self.write_module('pkg/module.py', ['x = 1'])
+        self.write_module('pkg/README.txt', [])
+        self.write_module('scripts/script.py', ['x = 1'])
+
+        collector = self.make_collector()
+
+        self.assertEqual(
+            sorted(collector.find_source_files()),
+            sorted([self.filename, self.unused, package, module, self.omitted,
+                    os.path.join(self.source_dir, 'migrations/__init__.py')])
+        )
+
+    @skipUnless(LineCollector.is_supported(), 'requires sys.monitoring')
+    def test_collects_lines_run_per_test(self):
+        target = self.load(self.filename)['target']
+
+        collector = self.make_collector()
+        collector.start()
+        target(True)
+        target(True)
+        collector.stop()
+
+        self.assertEqual(collector.get_data().lines(self.filename), [2, 3])
+
+        # lines disabled while collecting the last test are collected again
+        collector = self.make_collector()
+        collector.start()
+        target(False)
+        self.load(self.omitted)
+        collector.stop()
+
+        data = collector.get_data()
+        self.assertEqual(data.lines(self.filename), [2, 4])
+
+        # like coverage.py, files that never ran are measured with no lines
+        self.assertEqual(sorted(data.measured_files()),
+                         sorted([self.filename, self.unused]))
+        self.assertEqual(data.lines(self.unused), [])
+
+    @skipUnless(LineCollector.is_supported(), 'requires sys.monitoring')
+    def test_uses_a_free_tool_id(self):
+        monitoring = sys.monitoring
+        taken = [tool_id for tool_id in range(6)
+                 if monitoring.get_tool(tool_id) is None]
+
+        for tool_id in taken:
+            monitoring.use_tool_id(tool_id, 'other tool')
+
+        try:
+            self.assertFalse(LineCollector.is_available())
+
+            # e.g. coverage.py keeps COVERAGE_ID
+            monitoring.free_tool_id(monitoring.PROFILER_ID)
+            self.assertTrue(LineCollector.is_available())
+
+            collector = self.make_collector()
+            collector.start()
+            self.assertEqual(monitoring.get_tool(monitoring.PROFILER_ID),
+                             LineCollector.TOOL_NAME)
+            collector.stop()
+
+            self.assertIsNone(monitoring.get_tool(monitoring.PROFILER_ID))
+        finally:
+            for tool_id in taken:
+                if monitoring.get_tool(tool_id) is not None:
+                    monitoring.free_tool_id(tool_id)
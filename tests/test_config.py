@@ -1,6 +1,7 @@
-from unittest import TestCase
+from unittest import TestCase, skipIf
 
 import re
+import sys
 
 from codemon.config import Config
 
@@ -10,9 +11,11 @@ class TestConfig(TestCase):
         self.omit = ['*/migrations/*', '*/tests/*', '*tests.py']
         self.source = ['*/codemon/*']
         self.omit_tests = ['foo*']
+        self.packages = ['packages/foo', 'packages/bar']
         self.config = Config(omit=self.omit,
                              source=self.source,
-                             omit_tests=self.omit_tests)
+                             omit_tests=self.omit_tests,
+                             packages=self.packages)
 
     def check_regex(self, regex):
         self.assertTrue(re.search(regex, 'foo'))
@@ -25,6 +28,7 @@ class TestConfig(TestCase):
         self.assertEqual(config.source, self.source)
         self.assertEqual(len(config.omit_tests), len(self.omit_tests))
         self.check_regex(config.omit_tests[0])
+        self.assertEqual(config.packages, self.packages)
 
     def test_init(self):
         self.assert_config_correct(self.config)
@@ -32,3 +36,18 @@ class TestConfig(TestCase):
     def test_from_file(self):
         config = Config.from_file('tests/sample_config.txt')
         self.assert_config_correct(config)
+
+    def test_packages_default_to_empty(self):
+        self.assertEqual(Config().packages, [])
+
+    def test_collector(self):
+        self.assertEqual(Config().collector, 'auto')
+        self.assertEqual(Config(collector='coverage').collector, 'coverage')
+
+        with self.assertRaises(Exception):
+            Config(collector='no_such_collector')
+
+    @skipIf(hasattr(sys, 'monitoring'), 'sys.monitoring is available')
+    def test_monitoring_collector_requires_sys_monitoring(self):
+        with self.assertRaises(Exception):
+            Config(collector='monitoring')
@@ -1,6 +1,11 @@
 from unittest import TestCase
 
-from codemon.datastructures import _SourceTestMap, SourceMap
+import os
+import shutil
+import tempfile
+
+from codemon.datastructures import (_SourceTestMap, ResultCache,
+                                    ShardedSourceMap, SourceMap)
 
 
 class Test_SourceTestMap(TestCase):
@@ -159,3 +164,389 @@ class TestSourceMap(TestCase):
         retrieved_obj = SourceMap.read_from_file()
 
         self.assertEqual(self.obj, retrieved_obj)
+
+    def test_discard(self):
+        self.obj[self.filenames[1]] = (self.tests[0], [1, 7])
+        self.obj.discard(self.tests[2])
+
+        expected = _SourceTestMap(self.filenames[1])
+        expected.add(1, self.tests[0])
+        expected.add(7, self.tests[0])
+
+        self.assertEqual(self.obj[self.filenames[1]], expected)
+        self.assertEqual(self.obj.suite(), {self.tests[0]})
+        self.assertNotIn(self.tests[2], self.obj.coverage)
+
+    def test_coverage_is_kept_in_sync(self):
+        self.assertEqual(dict(self.obj.coverage), {
+            self.tests[2]: {self.filenames[1]: set(self.covered_lines)},
+        })
+
+        self.obj[self.filenames[0]] = (self.tests[0], [2])
+        self.assertEqual(self.obj.coverage[self.tests[0]],
+                         {self.filenames[0]: {2}})
+
+        del self.obj[self.filenames[1]]
+        self.assertEqual(dict(self.obj.coverage), {
+            self.tests[0]: {self.filenames[0]: {2}},
+        })
+
+    def test_coverage_is_kept_in_sync_on_pop(self):
+        self.obj[self.filenames[0]] = (self.tests[0], [2])
+
+        self.obj.pop(self.filenames[1])
+        self.assertEqual(dict(self.obj.coverage), {
+            self.tests[0]: {self.filenames[0]: {2}},
+        })
+        self.assertIsNone(self.obj.pop(self.filenames[1], None))
+
+        self.obj.popitem()
+        self.assertEqual(dict(self.obj.coverage), {})
+        self.assertEqual(self.obj.layouts, {})
+
+        # nothing is left to trip over
+        self.obj.discard(self.tests[0])
+
+    def test_coverage_is_kept_in_sync_on_clear(self):
+        self.obj.clear()
+
+        self.assertEqual(dict(self.obj.coverage), {})
+        self.assertEqual(self.obj.layouts, {})
+        self.obj.discard(self.tests[2])
+
+    def test_coverage_is_rebuilt_on_replace(self):
+        stm = _SourceTestMap(self.filenames[1])
+        stm.add(9, self.tests[1])
+        self.obj[self.filenames[1]] = stm
+
+        self.assertEqual(dict(self.obj.coverage), {
+            self.tests[1]: {self.filenames[1]: {9}},
+        })
+
+    def test_serialize_coverage(self):
+        serialized_data = SourceMap.serialize(self.obj)
+        test_bar_index = self.expected_index['test_bar']
+
+        self.assertEqual(serialized_data[2], {
+            test_bar_index: {1: self.covered_lines},
+        })
+
+    def test_deserialize_preserves_coverage(self):
+        self.obj[self.filenames[0]] = (self.tests[0], [2])
+
+        actual = SourceMap.deserialize(SourceMap.serialize(self.obj))
+        self.assertEqual(actual.coverage, self.obj.coverage)
+
+        # maps without a persisted reverse index get it rebuilt
+        actual = SourceMap.deserialize(SourceMap.serialize(self.obj)[:2])
+        self.assertEqual(actual.coverage, self.obj.coverage)
+
+    def test_covered_lines(self):
+        self.obj[self.filenames[0]] = (self.tests[2], [2])
+        self.obj[self.filenames[0]] = (self.tests[0], [1])
+
+        covered = self.obj.covered_lines([self.tests[2]])
+
+        self.assertEqual(list(covered), [self.tests[2]])
+        self.assertEqual(dict(covered[self.tests[2]]), {
+            self.filenames[0]: [2],
+            self.filenames[1]: self.covered_lines,
+        })
+
+
+class TestFingerprints(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmpdir, 'foo.py')
+        self.write_source(['def foo():', '    return 1', '', '# comment'])
+
+        self.obj = SourceMap()
+        self.obj[self.filename] = ('test_foo', [1, 2])
+        self.obj[self.filename] = ('test_bar', [1])
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def write_source(self, lines):
+        with open(self.filename, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+
+    def test_unchanged_lines_keep_fingerprint(self):
+        before = self.obj.fingerprints(['test_foo', 'test_bar'])
+        self.write_source(['def foo():', '    return 1', '', '# edited'])
+        after = self.obj.fingerprints(['test_foo', 'test_bar'])
+
+        self.assertEqual(before, after)
+
+    def test_changed_covered_line_changes_fingerprint(self):
+        before = self.obj.fingerprints(['test_foo', 'test_bar'])
+        self.write_source(['def foo():', '    return 2', '', '# comment'])
+        after = self.obj.fingerprints(['test_foo', 'test_bar'])
+
+        self.assertNotEqual(before['test_foo'], after['test_foo'])
+        self.assertEqual(before['test_bar'], after['test_bar'])
+
+    def test_shifted_lines_keep_fingerprint(self):
+        before = self.obj.fingerprints(['test_foo', 'test_bar'])
+        self.write_source(['# header', '', 'def foo():  # edited', '',
+                           '    return 1', '', '# comment'])
+        after = self.obj.fingerprints(['test_foo', 'test_bar'])
+
+        self.assertEqual(before, after)
+
+    def test_shifted_lines_are_followed(self):
+        before = self.obj.fingerprints(['test_foo'])
+        self.write_source(['# header', 'def foo():', '    return 2', '',
+                           '# comment'])
+        after = self.obj.fingerprints(['test_foo'])
+
+        self.assertIsNotNone(after['test_foo'])
+        self.assertNotEqual(before, after)
+
+    def test_code_added_to_covered_function_changes_fingerprint(self):
+        before = self.obj.fingerprints(['test_foo'])
+        self.write_source(['def foo():', '    raise ValueError', '',
+                           '    return 1', '', '# comment'])
+        after = self.obj.fingerprints(['test_foo'])
+
+        self.assertNotEqual(before, after)
+
+    def test_changed_default_argument_changes_fingerprint(self):
+        self.write_source(['def foo(x, y=1):', '    return x + y'])
+        self.obj.refresh_layouts()
+        self.obj.discard('test_foo')
+        self.obj[self.filename] = ('test_foo', [2])
+
+        before = self.obj.fingerprints(['test_foo'])
+        self.write_source(['def foo(x, y=5):', '    return x + y'])
+        after = self.obj.fingerprints(['test_foo'])
+
+        self.assertNotEqual(before, after)
+
+    def test_changed_module_constant_changes_fingerprint(self):
+        before = self.obj.fingerprints(['test_foo'])
+        self.write_source(['LIMIT = 0', 'def foo():', '    return 1', '',
+                           '# comment'])
+        after = self.obj.fingerprints(['test_foo'])
+
+        self.assertNotEqual(before, after)
+
+    def test_rewritten_lines_have_no_fingerprint(self):
+        self.write_source(['def foo():', '    return (', '        1)', '',
+                           '# comment'])
+
+        self.assertEqual(self.obj.fingerprints(['test_foo']),
+                         {'test_foo': None})
+
+        self.obj.refresh_layouts()
+        self.assertIsNotNone(self.obj.fingerprints(['test_foo'])['test_foo'])
+
+    def test_unparsable_file_has_no_fingerprint(self):
+        self.write_source(['def foo(:', '    return 1'])
+
+        self.assertEqual(self.obj.fingerprints(['test_bar']),
+                         {'test_bar': None})
+
+    def test_layouts_are_serialized(self):
+        actual = SourceMap.deserialize(SourceMap.serialize(self.obj))
+        self.assertEqual(actual.layouts, self.obj.layouts)
+
+    def test_deleted_file_changes_fingerprint(self):
+        before = self.obj.fingerprints(['test_foo'])
+        os.remove(self.filename)
+        after = self.obj.fingerprints(['test_foo'])
+
+        self.assertNotEqual(before, after)
+
+
+class TestShardedSourceMap(TestCase):
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.tmpdir = tempfile.mkdtemp()
+        os.chdir(self.tmpdir)
+        self.foo_root = os.path.join(self.tmpdir, 'foo')
+        self.bar_root = os.path.join(self.tmpdir, 'bar')
+        self.nested_root = os.path.join(self.foo_root, 'nested')
+
+        for root in (self.foo_root, self.bar_root, self.nested_root):
+            os.makedirs(root)
+
+        self.foo_file = os.path.join(self.foo_root, 'foo.py')
+        self.bar_file = os.path.join(self.bar_root, 'bar.py')
+        self.nested_file = os.path.join(self.nested_root, 'nested.py')
+        self.other_file = os.path.join(self.tmpdir, 'other.py')
+
+        self.roots = [self.foo_root, self.bar_root, self.nested_root]
+        self.obj = ShardedSourceMap(self.roots)
+        self.obj[self.foo_file] = ('test_foo', [1, 2])
+        self.obj[self.bar_file] = ('test_bar', [3])
+        self.obj[self.nested_file] = ('test_foo', [4])
+        self.obj.touch(self.other_file)
+
+        self.index_filename = os.path.join(self.tmpdir, 'index')
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.tmpdir)
+
+    def write_source(self, filename, lines):
+        with open(filename, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+
+    def save_and_reload(self, obj):
+        ShardedSourceMap.write_to_file(obj, self.index_filename)
+        return ShardedSourceMap.read_from_file(self.roots, self.index_filename)
+
+    def test_routing(self):
+        self.assertEqual(self.obj.route(self.foo_file), self.foo_root)
+        self.assertEqual(self.obj.route(self.bar_file), self.bar_root)
+        self.assertEqual(self.obj.route(self.nested_file), self.nested_root)
+        self.assertEqual(self.obj.route(self.other_file),
+                         ShardedSourceMap.TOP_LEVEL)
+
+    def test_files_move_to_packages_added_later(self):
+        obj = ShardedSourceMap([self.foo_root, self.bar_root])
+        obj[self.foo_file] = ('test_foo', [1, 2])
+        obj[self.nested_file] = ('test_nested', [4])
+        ShardedSourceMap.write_to_file(obj, self.index_filename)
+
+        obj = ShardedSourceMap.read_from_file(self.roots, self.index_filename)
+
+        self.assertEqual(obj.route(self.nested_file), self.nested_root)
+        self.assertEqual(obj.suite([self.nested_file]), {'test_nested'})
+        self.assertEqual(obj.test_roots['test_nested'], {self.nested_root})
+        self.assertEqual(obj.covered_lines(['test_nested']),
+                         {'test_nested': {self.nested_file: [4]}})
+        self.assertNotIn(self.nested_file, obj.shard(self.foo_root))
+
+        obj = self.save_and_reload(obj)
+        self.assertEqual(obj.index[self.nested_file], self.nested_root)
+        self.assertEqual(obj.suite([self.nested_file]), {'test_nested'})
+
+    def test_files_come_from_index(self):
+        self.assertEqual(sorted(self.obj.files),
+                         sorted([self.foo_file, self.bar_file,
+                                 self.nested_file, self.other_file]))
+        self.assertEqual(self.obj.untested_files, [self.other_file])
+
+    def test_suite(self):
+        self.assertEqual(self.obj.suite([self.bar_file]), {'test_bar'})
+        self.assertEqual(self.obj.suite(), {'test_foo', 'test_bar'})
+        self.assertEqual(self.obj.suite(['unmapped.py']), set())
+
+    def test_shards_are_loaded_lazily(self):
+        index_filename = os.path.join(self.tmpdir, 'index')
+        ShardedSourceMap.write_to_file(self.obj, index_filename)
+
+        retrieved_obj = ShardedSourceMap.read_from_file(self.roots,
+                                                        index_filename)
+
+        self.assertEqual(retrieved_obj.index, self.obj.index)
+        self.assertEqual(retrieved_obj.shards, {})
+
+        retrieved_obj.suite([self.bar_file])
+        self.assertEqual(list(retrieved_obj.shards), [self.bar_root])
+
+    def test_tests_are_indexed_by_root(self):
+        retrieved_obj = self.save_and_reload(self.obj)
+
+        self.assertEqual(dict(retrieved_obj.test_roots), {
+            'test_foo': {self.foo_root, self.nested_root},
+            'test_bar': {self.bar_root},
+        })
+        self.assertEqual(retrieved_obj.untested_files, [self.other_file])
+        self.assertEqual(retrieved_obj.shards, {})
+
+    def test_covered_lines_loads_exactly_the_tests_shards(self):
+        retrieved_obj = self.save_and_reload(self.obj)
+
+        self.assertEqual(retrieved_obj.covered_lines(['test_foo']), {
+            'test_foo': {self.foo_file: [1, 2], self.nested_file: [4]},
+        })
+        self.assertEqual(set(retrieved_obj.shards),
+                         {self.foo_root, self.nested_root})
+
+    def test_discard_loads_exactly_the_tests_shards(self):
+        retrieved_obj = self.save_and_reload(self.obj)
+        retrieved_obj.discard('test_bar')
+
+        self.assertEqual(list(retrieved_obj.shards), [self.bar_root])
+        self.assertEqual(retrieved_obj.suite([self.bar_file]), set())
+        self.assertEqual(sorted(retrieved_obj.untested_files),
+                         sorted([self.bar_file, self.other_file]))
+
+    def test_fingerprints_do_not_depend_on_loaded_shards(self):
+        self.write_source(self.foo_file, ['x = 1'])
+        self.write_source(self.bar_file, ['y = 1'])
+
+        obj = ShardedSourceMap(self.roots)
+        obj[self.foo_file] = ('test', [1])
+        obj[self.bar_file] = ('test', [1])
+
+        # a session where only foo changed
+        retrieved_obj = self.save_and_reload(obj)
+        retrieved_obj.suite([self.foo_file])
+        before = retrieved_obj.fingerprints(['test'])
+
+        # a session where everything is loaded
+        retrieved_obj = self.save_and_reload(obj)
+        retrieved_obj.suite(retrieved_obj.files)
+        self.assertEqual(retrieved_obj.fingerprints(['test']), before)
+
+        # bar is edited while codemon is not running, then foo changes again
+        self.write_source(self.bar_file, ['y = 2'])
+        retrieved_obj = self.save_and_reload(obj)
+        retrieved_obj.suite([self.foo_file])
+
+        self.assertNotEqual(retrieved_obj.fingerprints(['test']), before)
+
+    def test_old_indexes_are_rebuilt(self):
+        ShardedSourceMap.write_to_file(self.obj, self.index_filename)
+        retrieved_obj = ShardedSourceMap.deserialize(self.roots,
+                                                     dict(self.obj.index))
+
+        self.assertEqual(retrieved_obj.test_roots, self.obj.test_roots)
+        self.assertEqual(retrieved_obj.untested, self.obj.untested)
+
+    def test_shards_are_saved_in_their_packages(self):
+        ShardedSourceMap.write_to_file(self.obj,
+                                       os.path.join(self.tmpdir, 'index'))
+
+        for root in self.roots:
+            self.assertTrue(os.path.exists(
+                os.path.join(root, SourceMap.DEFAULT_FILENAME)
+            ))
+
+
+class TestResultCache(TestCase):
+    def setUp(self):
+        self.obj = ResultCache()
+        self.obj.record('test_foo', 'abc', True)
+        self.obj.record('test_bar', 'def', False)
+
+    def test_lookup(self):
+        self.assertEqual(self.obj.lookup('test_foo', 'abc'), (True, True))
+        self.assertEqual(self.obj.lookup('test_bar', 'def'), (True, False))
+        self.assertEqual(self.obj.lookup('test_foo', 'xyz'), (False, None))
+        self.assertEqual(self.obj.lookup('test_baz', 'abc'), (False, None))
+        self.assertEqual(self.obj.lookup('test_foo', None), (False, None))
+
+    def test_serialize_deserialize_are_inverses(self):
+        serialized = ResultCache.serialize(self.obj)
+        actual = ResultCache.deserialize(serialized)
+
+        self.assertEqual(actual, self.obj)
+
+    def test_write_to_file_replaces_file(self):
+        tmpdir = tempfile.mkdtemp()
+        filename = os.path.join(tmpdir, ResultCache.DEFAULT_FILENAME)
+
+        try:
+            ResultCache.write_to_file(ResultCache(), filename)
+            ResultCache.write_to_file(self.obj, filename)
+
+            self.assertEqual(ResultCache.read_from_file(filename), self.obj)
+            self.assertEqual(os.listdir(tmpdir),
+                             [ResultCache.DEFAULT_FILENAME])
+        finally:
+            shutil.rmtree(tmpdir)
@@ -0,0 +1,267 @@
+from unittest import TestCase, skipUnless
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from codemon.codemon import InfluenceMapper
+from codemon.collector import LineData
+from codemon.config import Config
+from codemon.datastructures import ResultCache
+from codemon.watcher import Watcher
+
+if sys.version_info >= (3, 7):
+    import asyncio
+
+    from codemon.engine import AsyncCodemon
+
+
+class StubMapper(InfluenceMapper):
+    def setup(self):
+        self.runs = []
+
+    def index_tests(self):
+        return ['test_a', 'test_b', 'test_c']
+
+    def test_suite(self, suite):
+        self.runs.append(set(suite))
+
+        return {test_name: True for test_name in suite}
+
+
+class RemapStubMapper(StubMapper):
+    """Maps every test to line 1 of `filename`, which is saved mid-run."""
+    filename = None
+    saved_content = None
+
+    def run_coverage(self, test_name):
+        coverage_data = LineData()
+        coverage_data.add_line(self.filename, 1)
+
+        return coverage_data
+
+    def test_suite(self, suite):
+        if self.saved_content is not None:
+            with open(self.filename, 'w') as f:
+                f.write(self.saved_content)
+
+        return super(RemapStubMapper, self).test_suite(suite)
+
+
+class CommandStubMapper(StubMapper):
+    def test_command(self, test_name):
+        return [sys.executable, '-c',
+                'import sys; sys.exit({})'.format(int(test_name == 'test_b'))]
+
+
+@skipUnless(sys.version_info >= (3, 7), 'requires asyncio.run')
+class TestAsyncCodemon(TestCase):
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.tmpdir = tempfile.mkdtemp()
+        os.chdir(self.tmpdir)
+
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+        self.changed_files = Watcher.__dict__['changed_files']
+
+        self.filenames = {}
+        for name in ('a', 'b', 'c'):
+            self.filenames[name] = os.path.join(self.tmpdir, name + '.py')
+            self.touch(name)
+
+    def tearDown(self):
+        Watcher.changed_files = self.changed_files
+
+        asyncio.set_event_loop(None)
+        self.loop.close()
+        os.chdir(self.cwd)
+        shutil.rmtree(self.tmpdir)
+
+    def touch(self, name, content='x = 1'):
+        with open(self.filenames[name], 'w') as f:
+            f.write(content + '\n')
+
+    def make_codemon(self, mapper_class=StubMapper, remap=False):
+        codemon = AsyncCodemon(config=Config(), mapper_class=mapper_class,
+                               use_cached=True, frequency=0, debounce=0.01,
+                               remap=remap)
+        codemon.mapper.setup()
+
+        for name, filename in self.filenames.items():
+            codemon.mapper.source_map[filename] = ('test_' + name, [1])
+
+        return codemon
+
+    def stub_changed_files(self, *changes):
+        """Has the watcher report each of `changes` in turn, then none."""
+        changes = [[self.filenames[name] for name in names]
+                   for names in changes]
+
+        def changed_files(watcher):
+            return changes.pop(0) if changes else []
+
+        Watcher.changed_files = changed_files
+
+    def start(self, coroutine):
+        return self.loop.create_task(coroutine)
+
+    def finish(self, *tasks):
+        for task in tasks:
+            task.cancel()
+
+        self.loop.run_until_complete(
+            asyncio.gather(*tasks, return_exceptions=True)
+        )
+
+    def get(self, queue):
+        return self.loop.run_until_complete(asyncio.wait_for(queue.get(), 5))
+
+    def run_affected_tests(self, codemon, names):
+        """Runs the tests affected by `names` outside of `serve`."""
+        codemon._dirty = asyncio.Event()
+        codemon.watcher = Watcher(list(codemon.mapper.files), callback=None)
+
+        return self.loop.run_until_complete(codemon.run_affected_tests(
+            [self.filenames[name] for name in names]
+        ))
+
+    def test_watch_queues_changed_files(self):
+        codemon = self.make_codemon()
+        codemon.watcher = Watcher([], callback=None)
+        self.stub_changed_files(['a', 'b'], [], ['c'])
+
+        changes = asyncio.Queue()
+        task = self.start(codemon._watch(changes))
+
+        self.assertEqual([self.get(changes) for _ in range(3)],
+                         [self.filenames[name] for name in 'abc'])
+        self.finish(task)
+
+    def test_queued_changes_are_batched_together(self):
+        codemon = self.make_codemon()
+        changes = asyncio.Queue()
+        batches = asyncio.Queue()
+
+        changes.put_nowait(self.filenames['b'])
+        changes.put_nowait(self.filenames['a'])
+        changes.put_nowait(self.filenames['b'])
+        task = self.start(codemon._debounce(changes, batches))
+
+        self.assertEqual(self.get(batches),
+                         [self.filenames['a'], self.filenames['b']])
+
+        changes.put_nowait(self.filenames['c'])
+        self.assertEqual(self.get(batches), [self.filenames['c']])
+
+        self.finish(task)
+
+    def test_batches_queued_during_a_run_are_coalesced(self):
+        codemon = self.make_codemon()
+        runs = asyncio.Queue()
+
+        def run_affected_tests(filenames):
+            runs.put_nowait(filenames)
+
+            done = self.loop.create_future()
+            done.set_result({})
+            return done
+
+        codemon.run_affected_tests = run_affected_tests
+
+        batches = asyncio.Queue()
+        batches.put_nowait([self.filenames['a']])
+        batches.put_nowait([self.filenames['b'], self.filenames['c']])
+        task = self.start(codemon._schedule(batches))
+
+        self.assertEqual(self.get(runs),
+                         [self.filenames[name] for name in 'abc'])
+
+        batches.put_nowait([self.filenames['a']])
+        self.assertEqual(self.get(runs), [self.filenames['a']])
+
+        self.finish(task)
+
+    def test_serve_runs_and_persists_changed_tests(self):
+        codemon = self.make_codemon()
+        run_affected_tests = codemon.run_affected_tests
+        self.stub_changed_files(['a', 'b'])
+
+        def run_and_stop(filenames):
+            task = asyncio.ensure_future(run_affected_tests(filenames))
+            task.add_done_callback(lambda _: codemon.stop())
+            return task
+
+        codemon.run_affected_tests = run_and_stop
+
+        self.loop.run_until_complete(
+            asyncio.wait_for(codemon.serve(), 10)
+        )
+
+        self.assertEqual(codemon.mapper.runs, [{'test_a', 'test_b'}])
+        self.assertEqual(sorted(ResultCache.read_from_file()),
+                         ['test_a', 'test_b'])
+
+    def test_unchanged_tests_are_skipped(self):
+        codemon = self.make_codemon()
+
+        self.touch('a', 'x = 2')
+        self.run_affected_tests(codemon, ['a'])
+        self.run_affected_tests(codemon, ['a'])
+
+        self.assertEqual(codemon.mapper.runs, [{'test_a'}])
+
+    def test_remapped_results_are_cached(self):
+        codemon = self.make_codemon(mapper_class=RemapStubMapper, remap=True)
+        codemon.mapper.filename = self.filenames['a']
+
+        self.run_affected_tests(codemon, ['a'])
+        self.run_affected_tests(codemon, ['a'])
+
+        self.assertEqual(codemon.mapper.runs, [{'test_a'}])
+
+    def test_results_of_files_saved_mid_run_are_not_cached(self):
+        codemon = self.make_codemon(mapper_class=RemapStubMapper, remap=True)
+        codemon.mapper.filename = self.filenames['a']
+        codemon.mapper.saved_content = 'x = 2\n'
+
+        self.assertEqual(self.run_affected_tests(codemon, ['a']),
+                         {'test_a': True})
+        self.assertNotIn('test_a', codemon.mapper.result_cache)
+
+    def test_tests_are_run_with_test_command(self):
+        codemon = self.make_codemon(mapper_class=CommandStubMapper)
+
+        results = self.run_affected_tests(codemon, ['a', 'b'])
+
+        self.assertEqual(results, {'test_a': True, 'test_b': False})
+        self.assertEqual(codemon.mapper.runs, [])
+
+    def test_run_test_commands(self):
+        codemon = self.make_codemon()
+
+        results = self.loop.run_until_complete(codemon.run_test_commands({
+            'test_pass': [sys.executable, '-c', 'pass'],
+            'test_fail': [sys.executable, '-c', 'raise SystemExit(1)'],
+            'test_error': [os.path.join(self.tmpdir, 'no_such_binary')],
+        }))
+
+        self.assertEqual(results, {'test_pass': True, 'test_fail': False})
+
+    def test_cancelled_test_commands_are_killed(self):
+        codemon = self.make_codemon()
+        start = time.time()
+
+        with self.assertRaises(asyncio.TimeoutError):
+            self.loop.run_until_complete(asyncio.wait_for(
+                codemon.run_test_commands({
+                    'test_slow': [sys.executable, '-c',
+                                  'import time; time.sleep(30)'],
+                }),
+                0.5
+            ))
+
+        self.assertLess(time.time() - start, 5)